@@ -1,4 +1,3 @@
-import gc
 import rawpy
 import numpy as np
 import colour
@@ -9,7 +8,7 @@ from typing import Optional
 from raw_alchemy import utils
 from raw_alchemy.config import LOG_TO_WORKING_SPACE, LOG_ENCODING_MAP
 from raw_alchemy.logger import create_logger
-from raw_alchemy.metering import apply_auto_exposure
+from raw_alchemy.metering import calculate_auto_exposure_gain
 from raw_alchemy.file_io import save_image
 
 
@@ -27,6 +26,7 @@ def process_image(
     metering_mode: str = 'hybrid',
     custom_db_path: Optional[str] = None,
     log_queue: Optional[object] = None, # 多进程通信队列
+    lens_workers: Optional[int] = None, # 镜头校正线程数，None=全部核心
 ):
     filename = os.path.basename(raw_path)
     
@@ -37,6 +37,8 @@ def process_image(
 
     # --- Step 1: 解码 RAW (统一至 ProPhoto RGB / 16-bit Linear) ---
     logger.info(f"  🔹 [Step 1] Decoding RAW...")
+    source_cs = colour.RGB_COLOURSPACES['ProPhoto RGB']
+
     with rawpy.imread(raw_path) as raw:
         # 提取 EXIF (用于镜头校正)
         exif_data = utils.extract_lens_exif(raw, logger=logger.log)
@@ -52,25 +54,27 @@ def process_image(
             highlight_mode=2, # 2=Blend (防止高光死白)
             demosaic_algorithm=rawpy.DemosaicAlgorithm.AAHD,
         )
-        # 转为 Float32 (0.0 - 1.0) 进行数学运算
-        img = prophoto_linear.astype(np.float32) / 65535.0
-        
-        # 立即释放内存
-        del prophoto_linear 
-        gc.collect()
 
-    source_cs = colour.RGB_COLOURSPACES['ProPhoto RGB']
+        # --- Step 2: 曝光控制 ---
+        # 直接在 16-bit 解码结果上确定增益，随后在转换 Float32 的同一次遍历中应用
+        if exposure is not None:
+            # 路径 A: 手动曝光
+            logger.info(f"  🔹 [Step 2] Manual Exposure Override ({exposure:+.2f} stops)")
+            gain = 2.0 ** exposure
+        else:
+            # 路径 B: 自动测光（使用策略模式）
+            # 测光只需要下采样的小图，无需先把整张图转换为 Float32
+            logger.info(f"  🔹 [Step 2] Auto Exposure ({metering_mode})")
+            sample = utils.get_subsampled_view(prophoto_linear) * np.float32(1.0 / 65535.0)
+            gain = calculate_auto_exposure_gain(sample, source_cs, metering_mode, target_gray=0.18, logger=logger)
 
-    # --- Step 2: 曝光控制 ---
-    if exposure is not None:
-        # 路径 A: 手动曝光
-        logger.info(f"  🔹 [Step 2] Manual Exposure Override ({exposure:+.2f} stops)")
-        gain = 2.0 ** exposure
-        utils.apply_gain_inplace(img, gain)
-    else:
-        # 路径 B: 自动测光（使用策略模式）
-        logger.info(f"  🔹 [Step 2] Auto Exposure ({metering_mode})")
-        img = apply_auto_exposure(img, source_cs, metering_mode, target_gray=0.18, logger=logger)
+        # 转为 Float32 (0.0 - 1.0) 并应用曝光增益
+        # 单次遍历写入预分配数组，峰值内存只有 uint16 + 一张 float32
+        img = np.empty(prophoto_linear.shape, dtype=np.float32)
+        utils.u16_to_float_normalized(prophoto_linear, img, np.float32(gain))
+        
+        # 立即释放 16-bit 解码结果 (ndarray 没有循环引用，引用计数归零即释放，无需 gc.collect)
+        del prophoto_linear
 
     # --- Step 3: 镜头校正 & 风格化 ---
     if lens_correct:
@@ -79,14 +83,16 @@ def process_image(
             img,
             exif_data=exif_data,
             custom_db_path=custom_db_path,
-            logger=logger.log
+            logger=logger.log,
+            max_workers=lens_workers,
         )
     else:
         logger.info("  🔹 [Step 3] Skipping Lens Correction.")
 
-    # 稍微增加饱和度和对比度，为 LUT 转换打底
-    logger.info("  🔹 [Step 3.5] Applying Camera-Match Boost...")
-    img = utils.apply_saturation_and_contrast(img, saturation=1.25, contrast=1.1, colourspace=source_cs)
+    if not img.flags['C_CONTIGUOUS']:
+        img = np.ascontiguousarray(img)
+    if img.dtype != np.float32:
+        img = img.astype(np.float32)
 
     # --- Step 4: 色彩空间转换 (ProPhoto Linear -> Log) ---
     log_color_space_name = LOG_TO_WORKING_SPACE.get(log_space)
@@ -95,50 +101,45 @@ def process_image(
     if not log_color_space_name:
          raise ValueError(f"Unknown Log Space: {log_space}")
 
-    logger.info(f"  🔹 [Step 4] Color Transform (ProPhoto -> {log_color_space_name} -> {log_curve_name})")
-
-    # 4.1 Gamut 变换 (矩阵运算)
-    M = colour.matrix_RGB_to_RGB(
-        colour.RGB_COLOURSPACES['ProPhoto RGB'],
-        colour.RGB_COLOURSPACES[log_color_space_name],
-    )
-    if not img.flags['C_CONTIGUOUS']:
-        img = np.ascontiguousarray(img)
-    if img.dtype != np.float32:
-        img = img.astype(np.float32)
-    utils.apply_matrix_inplace(img, M)
-    
-    # 4.2 Log 编码
-    # Log 函数无法处理负值，需裁剪微小底噪
-    np.maximum(img, 1e-6, out=img) 
-    img = colour.cctf_encoding(img, function=log_curve_name)
+    # Gamut 变换矩阵 (按目标色彩空间缓存)
+    M = utils.get_gamut_matrix(log_color_space_name)
 
-    # --- Step 5: 应用 LUT ---
+    # --- Step 5: 读取 LUT ---
+    lut = None
+    lut_table = None
     if lut_path:
-        logger.info(f"  🔹 [Step 5] Applying LUT {os.path.basename(lut_path)}...")
         try:
             lut = colour.read_LUT(lut_path)
-            
-            # 3D LUT 使用 Numba 加速
             if isinstance(lut, colour.LUT3D):
-                if not img.flags['C_CONTIGUOUS']:
-                    img = np.ascontiguousarray(img)
-                if img.dtype != np.float32:
-                    img = img.astype(np.float32)
-                if lut.table.dtype != np.float32:
-                    lut.table = lut.table.astype(np.float32)
-                utils.apply_lut_inplace(img, lut.table, lut.domain[0], lut.domain[1])
-            else:
-                # 1D LUT 使用 colour 库默认方法
-                img = lut.apply(img)
-            
+                lut_table = utils.prepare_lut3d_table(lut)
+            # LUT 在条带循环中才真正应用，先用单像素试跑一次:
+            # 无法应用的 LUT 在这里被跳过，图像仍按无 LUT 输出
+            utils.apply_lut(np.full((1, 1, 3), 0.5, dtype=np.float32), lut, table=lut_table)
         except Exception as e:
             logger.error(f"  ❌ applying LUT: {e}")
+            lut = None
+            lut_table = None
+
+    # 稍微增加饱和度和对比度，为 LUT 转换打底
+    logger.info("  🔹 [Step 3.5] Applying Camera-Match Boost...")
+    logger.info(f"  🔹 [Step 4] Color Transform (ProPhoto -> {log_color_space_name} -> {log_curve_name})")
+    if lut is not None:
+        logger.info(f"  🔹 [Step 5] Applying LUT {os.path.basename(lut_path)}...")
+
+    # Step 3.5 - 5 逐条带处理:
+    # 每个条带在缓存中一次走完 风格化 -> Gamut + Log -> LUT，而不是每个阶段各遍历一次整图
+    stripe_rows = utils.get_stripe_rows(img)
+    for y0 in range(0, img.shape[0], stripe_rows):
+        stripe = img[y0:y0 + stripe_rows]
+        utils.apply_saturation_and_contrast(stripe, saturation=1.25, contrast=1.1, colourspace=source_cs)
+        utils.apply_gamut_and_log_inplace(stripe, M, log_curve_name)
+
+        if lut is not None:
+            # 3D LUT 使用 Numba 加速 (原位)，1D LUT 使用 colour 库默认方法 (返回新数组)
+            result = utils.apply_lut(stripe, lut, table=lut_table)
+            if result is not stripe:
+                stripe[...] = result
 
     # --- Step 6: 保存（使用模块化的文件保存功能）---
     logger.info(f"  💾 Saving to {os.path.basename(output_path)}...")
-    save_image(img, output_path, logger)
-    
-    # --- 最终清理 ---
-    del img
-    gc.collect()
\ No newline at end of file
+    save_image(img, output_path, logger)
\ No newline at end of file
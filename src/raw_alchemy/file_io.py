@@ -8,6 +8,7 @@ import tifffile
 from PIL import Image
 import pillow_heif
 from typing import Optional
+from raw_alchemy import utils
 from raw_alchemy.logger import Logger
 
 def save_image(
@@ -19,7 +20,7 @@ def save_image(
     保存图像到指定路径，根据扩展名自动选择格式
     
     Args:
-        img: 图像数据 (float32, 0.0-1.0)
+        img: 图像数据 (float32, 0.0-1.0)，超出范围的值在转换为整型时裁剪
         output_path: 输出路径
         logger: 日志处理器
     
@@ -30,9 +31,6 @@ def save_image(
         from .logger import create_logger
         logger = create_logger()
     
-    # 确保数据在有效范围内
-    np.clip(img, 0.0, 1.0, out=img)
-    
     file_ext = os.path.splitext(output_path)[1].lower()
     
     try:
@@ -53,25 +51,45 @@ def save_image(
         return False
 
 
+# TIFF 分块 (Tile) 尺寸
+TIFF_TILE_SIZE = (256, 256)
+
+
+def _iter_tiles_uint16(img: np.ndarray, tile_size: tuple):
+    """按 TIFF 分块顺序逐块转换为 uint16，不生成整图的 uint16 缓冲"""
+    height, width = img.shape[:2]
+    tile_h, tile_w = tile_size
+    for y in range(0, height, tile_h):
+        for x in range(0, width, tile_w):
+            tile = img[y:y + tile_h, x:x + tile_w]
+            tile_uint16 = np.empty(tile.shape, dtype=np.uint16)
+            utils.float_to_uint_clipped(tile, tile_uint16, 65535)
+            yield tile_uint16
+
+
 def _save_tiff(img: np.ndarray, output_path: str, logger: Logger):
-    """保存为 16-bit TIFF 格式"""
-    logger.info("    Format: TIFF (16-bit, ZLIB Optimized)")
-    output_image_uint16 = (img * 65535).astype(np.uint16)
+    """保存为 16-bit TIFF 格式 (分块写入，多线程压缩)"""
+    logger.info("    Format: TIFF (16-bit, Tiled Deflate)")
     
     tifffile.imwrite(
         output_path,
-        output_image_uint16,
+        _iter_tiles_uint16(img, TIFF_TILE_SIZE),
+        shape=img.shape,
+        dtype=np.uint16,
+        tile=TIFF_TILE_SIZE,
         photometric='rgb',
         compression='zlib',
         predictor=2,  # 水平差分，提升压缩率
-        compressionargs={'level': 8}  # 平衡速度和体积
+        compressionargs={'level': 1},  # 低压缩级别，优先写入速度
+        maxworkers=os.cpu_count()  # 各分块并行压缩
     )
 
 
 def _save_heif(img: np.ndarray, output_path: str, logger: Logger):
     """保存为 10-bit HEIF 格式"""
     logger.info("    Format: HEIF (10-bit, High Quality)")
-    output_image_uint16 = (img * 65535).astype(np.uint16)
+    output_image_uint16 = np.empty(img.shape, dtype=np.uint16)
+    utils.float_to_uint_clipped(img, output_image_uint16, 65535)
     
     heif_file = pillow_heif.from_bytes(
         mode='RGB;16',
@@ -85,8 +103,9 @@ def _save_jpeg_or_other(img: np.ndarray, output_path: str, file_ext: str, logger
     """保存为 8-bit JPEG 或其他格式"""
     logger.info(f"    Format: {file_ext.upper()} (8-bit High Quality)")
     
-    # 转换为 8-bit（img 已经在 save_image 中被 clip 过了）
-    output_image_uint8 = (img * 255).astype(np.uint8)
+    # 转换为 8-bit (裁剪 + 缩放 + 取整一次完成)
+    output_image_uint8 = np.empty(img.shape, dtype=np.uint8)
+    utils.float_to_uint_clipped(img, output_image_uint8, 255)
     
     # JPEG 特殊优化参数
     save_params = {}
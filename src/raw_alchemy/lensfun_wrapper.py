@@ -5,6 +5,7 @@ Lensfun库的Python包装器
 
 import ctypes
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import platform
 import os
@@ -428,6 +429,30 @@ class LensfunModifier:
 # 便捷函数
 # ============================================================================
 
+def _remap_stripe(filtered: np.ndarray, coords: np.ndarray, output: np.ndarray,
+                  c: int, y0: int, y1: int):
+    """对输出图像单个通道的一个行条带 [y0, y1) 做三次样条重采样
+    
+    参数:
+        filtered: 已经过 spline_filter 预滤波的单通道输入
+        coords: apply_subpixel_geometry_distortion 返回的 (h, w, RGB, xy) 坐标
+        output: 输出图像，第 c 通道的对应条带会被原地写入
+    """
+    from scipy.ndimage import map_coordinates
+
+    coords_c = coords[y0:y1, :, c, :]
+    coordinates = np.array([coords_c[:, :, 1], coords_c[:, :, 0]])
+
+    output[y0:y1, :, c] = map_coordinates(
+        filtered,
+        coordinates,
+        order=3,
+        mode='constant',
+        cval=0.0,
+        prefilter=False
+    )
+
+
 def apply_lens_correction(
     image: np.ndarray,
     camera_maker: Optional[str],
@@ -443,6 +468,7 @@ def apply_lens_correction(
     distance: float = 1000.0,
     custom_db_path: Optional[str] = None,
     logger: callable = print,
+    max_workers: Optional[int] = None,
 ) -> np.ndarray:
     """应用镜头校正到图像
     
@@ -459,6 +485,8 @@ def apply_lens_correction(
         correct_tca: 是否校正横向色差
         correct_vignetting: 是否校正暗角
         distance: 对焦距离 (米)
+        max_workers: 重采样线程数，None 则使用全部 CPU 核心。
+            批处理中多个文件并发校正时应按任务数分摊，避免线程数成倍超额
     
     返回:
         校正后的图像（与输入相同dtype）
@@ -528,20 +556,25 @@ def apply_lens_correction(
         coords = modifier.apply_subpixel_geometry_distortion(0.0, 0.0, width, height)
         
         if coords is not None:
-            # 使用scipy的map_coordinates进行插值
-            from scipy.ndimage import map_coordinates
-            
-            for c in range(3):  # R, G, B
-                coords_c = coords[:, :, c, :]
-                coordinates = np.array([coords_c[:, :, 1], coords_c[:, :, 0]])
-                
-                output[:, :, c] = map_coordinates(
-                    image[:, :, c],
-                    coordinates,
-                    order=3,
-                    mode='constant',
-                    cval=0.0
-                )
+            # 使用scipy的样条插值，按行条带分发到线程池
+            # (map_coordinates 在 C 层释放 GIL，各条带互不依赖)
+            from scipy.ndimage import spline_filter
+
+            workers = max_workers or os.cpu_count() or 1
+            stripe_rows = max(1, -(-height // (workers * 4)))
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for c in range(3):  # R, G, B
+                    # 三次样条预滤波每个通道只做一次；
+                    # 直接调用 map_coordinates 会在每个条带上对整张输入重复预滤波
+                    filtered = spline_filter(image[:, :, c], order=3, output=np.float64, mode='constant')
+                    futures = [
+                        executor.submit(_remap_stripe, filtered, coords, output, c, y0, y0 + stripe_rows)
+                        for y0 in range(0, height, stripe_rows)
+                    ]
+                    for future in futures:
+                        future.result()
+                    del filtered
         else:
             output = image
     else:
@@ -86,13 +86,9 @@ class CenterWeightedMeteringStrategy:
         luminance = np.dot(sample, coeffs)
         
         h, w = luminance.shape
-        y, x = np.ogrid[:h, :w]
-        center_y, center_x = h / 2, w / 2
-        sigma = min(h, w) / 2
-        dist_sq = (x - center_x)**2 + (y - center_y)**2
-        weights = np.exp(-dist_sq / (2 * sigma**2))
+        weights, weights_sum = utils.get_center_weight_mask(h, w)
         
-        weighted_avg_lum = np.average(luminance, weights=weights)
+        weighted_avg_lum = np.dot(luminance.ravel(), weights) / weights_sum
         
         if weighted_avg_lum < 1e-6:
             gain = 1.0
@@ -120,7 +116,7 @@ class HighlightSafeMeteringStrategy:
 
         sample = utils.get_subsampled_view(img_linear)
         max_vals = np.max(sample, axis=2)
-        high_percentile = np.percentile(max_vals, 99.0)
+        high_percentile = utils.fast_percentile(max_vals, 99.0)
         
         target_high = 0.9
         if high_percentile < 1e-6:
@@ -156,7 +152,7 @@ class HybridMeteringStrategy:
         base_gain = target_gray / (avg_lum + 1e-6)
         
         max_vals = np.max(sample, axis=2)
-        p99 = np.percentile(max_vals, 99.0)
+        p99 = utils.fast_percentile(max_vals, 99.0)
         
         potential_peak = p99 * base_gain
         max_allowed_peak = 6.0
@@ -233,7 +229,7 @@ class MatrixMeteringStrategy:
         
         # 保护性削减
         max_vals = np.max(sample, axis=2)
-        p99 = np.percentile(max_vals, 99.0)
+        p99 = utils.fast_percentile(max_vals, 99.0)
         potential_peak = p99 * gain
         max_allowed_peak = 6.0
         
@@ -280,6 +276,31 @@ def get_metering_strategy(mode: str) -> MeteringStrategy:
     return strategy
 
 
+def calculate_auto_exposure_gain(
+    img_linear: np.ndarray,
+    source_colorspace,
+    metering_mode: str = 'hybrid',
+    target_gray: float = 0.18,
+    logger: Optional[Logger] = None
+) -> float:
+    """
+    只计算自动曝光增益，不修改图像
+    
+    Args:
+        img_linear: 线性图像数据 (可以是下采样后的小图)
+        source_colorspace: 源色彩空间
+        metering_mode: 测光模式
+        target_gray: 目标灰度值
+        logger: 日志处理器
+    
+    Returns:
+        float: 曝光增益值
+    """
+
+    strategy = get_metering_strategy(metering_mode)
+    return float(strategy.calculate_gain(img_linear, source_colorspace, target_gray, logger))
+
+
 def apply_auto_exposure(
     img_linear: np.ndarray,
     source_colorspace,
@@ -301,8 +322,7 @@ def apply_auto_exposure(
         np.ndarray: 调整后的图像
     """
 
-    strategy = get_metering_strategy(metering_mode)
-    gain = strategy.calculate_gain(img_linear, source_colorspace, target_gray, logger)
-    utils.apply_gain_inplace(img_linear, float(gain))
+    gain = calculate_auto_exposure_gain(img_linear, source_colorspace, metering_mode, target_gray, logger)
+    utils.apply_gain_inplace(img_linear, np.float32(gain))
     
     return img_linear
@@ -1,12 +1,23 @@
 import os
 import concurrent.futures
-from raw_alchemy import core
+from raw_alchemy import core, utils
 
 # Supported RAW file extensions (lowercase)
 SUPPORTED_RAW_EXTENSIONS = [
     '.dng', '.cr2', '.cr3', '.nef', '.arw', '.rw2', '.raf', '.orf', '.pef', '.srw'
 ]
 
+def _create_executor(jobs):
+    """
+    创建批处理执行器。
+    rawpy 解码和 Numba 核函数 (nogil) 都会释放 GIL，使用线程池即可并行，
+    省去子进程的启动、模块重复导入和每个进程各自加载的 JIT 缓存。
+    Numba 使用 workqueue 线程层时不支持并发调用并行核函数，此时退回进程池。
+    """
+    if utils.is_numba_threadsafe():
+        return concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+
 def process_path(
     input_path,
     output_path,
@@ -63,8 +74,11 @@ def process_path(
         count = len(raw_files)
         log_message(f"🔍 Found {count} RAW files for parallel processing.")
         send_signal({'total_files': count}) 
+
+        # 多个文件同时做镜头校正时按任务数分摊 CPU 核心，避免 jobs x cpu_count 个重采样线程
+        lens_workers = max(1, (os.cpu_count() or 1) // jobs)
         
-        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        with _create_executor(jobs) as executor:
             futures = {
                 executor.submit(
                     core.process_image,
@@ -76,6 +90,7 @@ def process_path(
                     lens_correct=lens_correct,
                     custom_db_path=custom_db_path,
                     metering_mode=metering_mode,
+                    lens_workers=lens_workers,
                     # Pass queue directly if it is one (for internal logging inside the worker)
                     log_queue=logger_func if hasattr(logger_func, 'put') else None 
                 ): filename for filename in raw_files
@@ -213,7 +213,8 @@ class PreviewWindow:
                     )
                     
                     # 转为Float32
-                    img = prophoto_linear.astype(np.float32) / 65535.0
+                    img = np.empty(prophoto_linear.shape, dtype=np.float32)
+                    utils.u16_to_float_normalized(prophoto_linear, img)
                     
                     # 缩小图像以加快预览（保持宽高比，最大边1600px）
                     h, w = img.shape[:2]
@@ -315,7 +316,7 @@ class PreviewWindow:
                 if params['exposure'] is not None:
                     # 手动曝光
                     gain = 2.0 ** params['exposure']
-                    utils.apply_gain_inplace(img, gain)
+                    utils.apply_gain_inplace(img, np.float32(gain))
                 else:
                     # 自动曝光
                     metering_mode = params['metering_mode']
@@ -331,35 +332,20 @@ class PreviewWindow:
                 
                 if log_color_space_name:
                     # Gamut变换
-                    M = colour.matrix_RGB_to_RGB(
-                        colour.RGB_COLOURSPACES['ProPhoto RGB'],
-                        colour.RGB_COLOURSPACES[log_color_space_name],
-                    )
+                    M = utils.get_gamut_matrix(log_color_space_name)
                     if not img.flags['C_CONTIGUOUS']:
                         img = np.ascontiguousarray(img)
                     if img.dtype != np.float32:
                         img = img.astype(np.float32)
-                    utils.apply_matrix_inplace(img, M)
-                    
-                    # Log编码
-                    np.maximum(img, 1e-6, out=img)
-                    img = colour.cctf_encoding(img, function=log_curve_name)
+                    # Log编码 (预编译曲线内核，与 Gamut 变换合并为单次原位遍历)
+                    utils.apply_gamut_and_log_inplace(img, M, log_curve_name)
                 
                 # 5. 应用LUT
                 lut_path = params['lut_path']
                 if lut_path:
                     try:
                         lut = colour.read_LUT(lut_path)
-                        if isinstance(lut, colour.LUT3D):
-                            if not img.flags['C_CONTIGUOUS']:
-                                img = np.ascontiguousarray(img)
-                            if img.dtype != np.float32:
-                                img = img.astype(np.float32)
-                            if lut.table.dtype != np.float32:
-                                lut.table = lut.table.astype(np.float32)
-                            utils.apply_lut_inplace(img, lut.table, lut.domain[0], lut.domain[1])
-                        else:
-                            img = lut.apply(img)
+                        img = utils.apply_lut(img, lut)
                     except Exception as e:
                         print(f"LUT应用错误: {e}")
                 
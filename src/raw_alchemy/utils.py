@@ -1,10 +1,11 @@
 import os
 import sys
+from functools import lru_cache
 from typing import Optional
 import rawpy
 import numpy as np
 from raw_alchemy import lensfun_wrapper as lf
-from numba import njit, prange
+from numba import njit, prange, get_num_threads, threading_layer
 
 
 def resource_path(relative_path):
@@ -19,13 +20,14 @@ def resource_path(relative_path):
 # Numba 加速核函数 (In-Place / 无内存分配)
 # =========================================================
 
-@njit(parallel=True, fastmath=True, cache=True)
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
 def apply_matrix_inplace(img, matrix):
     """
     高性能原位矩阵变换
     优化点: 
     1. 视图打平 (Flatten View) 以最大化并行粒度
     2. 显式读取变量以利用寄存器
+    3. matrix 应与 img 同为 float32，否则逐像素运算会被提升为 float64 (约慢 25%)
     """
     # 获取图像总像素数
     rows, cols, channels = img.shape
@@ -51,7 +53,7 @@ def apply_matrix_inplace(img, matrix):
         flat_img[i, 1] = r * m10 + g * m11 + b * m12
         flat_img[i, 2] = r * m20 + g * m21 + b * m22
 
-@njit(parallel=True, fastmath=True, cache=True)
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
 def apply_lut_inplace(img, lut_table, domain_min, domain_max):
     """
     高性能原位四面体插值 (Tetrahedral Interpolation)
@@ -304,11 +306,12 @@ def apply_lut_inplace(img, lut_table, domain_min, domain_max):
         flat_img[i, 1] = g_val
         flat_img[i, 2] = b_val
 
-@njit(parallel=True, fastmath=True)
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
 def apply_saturation_contrast_inplace(img, saturation, contrast, pivot, luma_coeffs):
     """
     原位应用饱和度和对比度。
     替代了原先创建 4 个大数组的 Python 函数。
+    标量参数应为 float32，否则逐像素运算会被提升为 float64。
     """
     rows, cols, _ = img.shape
     cr, cg, cb = luma_coeffs[0], luma_coeffs[1], luma_coeffs[2]
@@ -343,9 +346,44 @@ def apply_saturation_contrast_inplace(img, saturation, contrast, pivot, luma_coe
             img[r, c, 1] = g_fin
             img[r, c, 2] = b_fin
 
-@njit(parallel=True, fastmath=True)
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def u16_to_float_normalized(src_u16, dst_f32, gain=1.0):
+    """
+    uint16 -> float32 (0.0 - 1.0)，单次遍历写入预分配的目标数组。
+    替代 astype(np.float32) / 65535.0 (两次整图遍历，且分配两张 float32 整图)。
+    gain 为可选的曝光增益，与归一化合并在同一次乘法中完成。
+    """
+    rows, cols, channels = src_u16.shape
+    scale = np.float32(gain / 65535.0)
+    for r in prange(rows):
+        for c in range(cols):
+            for ch in range(channels):
+                dst_f32[r, c, ch] = src_u16[r, c, ch] * scale
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def float_to_uint_clipped(src, dst, max_value):
+    """
+    float32 (0.0 - 1.0) -> uint8 / uint16，单次遍历完成裁剪、缩放、四舍五入和类型转换。
+    超出 [0, 1] 的值饱和到 0 / max_value，不会在整型转换时回绕，也不需要中间的 float32 整图。
+    """
+    rows, cols, channels = src.shape
+    for r in prange(rows):
+        for c in range(cols):
+            for ch in range(channels):
+                v = src[r, c, ch]
+                if v <= 0.0:
+                    dst[r, c, ch] = 0
+                elif v >= 1.0:
+                    dst[r, c, ch] = max_value
+                else:
+                    dst[r, c, ch] = int(v * max_value + 0.5)
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
 def apply_gain_inplace(img, gain):
-    """简单的原位增益，比 numpy 的 img *= gain 稍微快一点点，且绝对不分配内存"""
+    """
+    简单的原位增益，比 numpy 的 img *= gain 稍微快一点点，且绝对不分配内存。
+    gain 应传入 np.float32，否则逐像素乘法会被提升为 float64。
+    """
     rows, cols, _ = img.shape
     for r in prange(rows):
         for c in range(cols):
@@ -353,7 +391,7 @@ def apply_gain_inplace(img, gain):
             img[r, c, 1] *= gain
             img[r, c, 2] *= gain
 
-@njit(parallel=True, fastmath=True, cache=True)
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
 def bt709_to_srgb_inplace(img):
     """
     快速原位转换: BT.709 -> sRGB
@@ -389,19 +427,220 @@ def bt709_to_srgb_inplace(img):
                 
                 img[r, c, ch] = result
 
+# =========================================================
+# Log 编码曲线 (与 colour 库默认参数一致，输出为归一化码值)
+# =========================================================
+
+# 曲线名称 -> Numba 核函数内部使用的分支编号
+LOG_CURVE_IDS = {
+    'F-Log': 0,
+    'F-Log2': 1,
+    'V-Log': 2,
+    'N-Log': 3,
+    'L-Log': 4,
+    'Canon Log 2': 5,
+    'Canon Log 3': 6,
+    'S-Log3': 7,
+    'Arri LogC3': 8,
+    'Arri LogC4': 9,
+    'Log3G10': 10,
+    'D-Log': 11,
+}
+
+@njit(fastmath=True, cache=True)
+def _log_encode(x, curve_id):
+    """单个线性值的 Log 编码 (输入需为正数)"""
+    if curve_id == 0:
+        # Fujifilm F-Log
+        if x < 0.00089:
+            return 8.735631 * x + 0.092864
+        return 0.344676 * np.log10(0.555556 * x + 0.009468) + 0.790453
+    elif curve_id == 1:
+        # Fujifilm F-Log2
+        if x < 0.000889:
+            return 8.799461 * x + 0.092864
+        return 0.245281 * np.log10(5.555556 * x + 0.064829) + 0.384316
+    elif curve_id == 2:
+        # Panasonic V-Log
+        if x < 0.01:
+            return 5.6 * x + 0.125
+        return 0.241514 * np.log10(x + 0.00873) + 0.598206
+    elif curve_id == 3:
+        # Nikon N-Log
+        if x < 0.328:
+            return (650.0 / 1023.0) * (x + 0.0075) ** (1.0 / 3.0)
+        return (150.0 / 1023.0) * np.log(x) + (619.0 / 1023.0)
+    elif curve_id == 4:
+        # Leica L-Log
+        if x <= 0.006:
+            return 8.0 * x + 0.09
+        return 0.27 * np.log10(1.3 * x + 0.0115) + 0.6
+    elif curve_id == 5:
+        # Canon Log 2 (v1.2)
+        return 0.24136077 * np.log10(x / 0.9 * 87.09937546 + 1.0) + 0.092864125
+    elif curve_id == 6:
+        # Canon Log 3 (v1.2)
+        x = x / 0.9
+        if x <= 0.014:
+            return 1.9754798 * x + 0.12512219
+        return 0.36726845 * np.log10(x * 14.98325 + 1.0) + 0.12240537
+    elif curve_id == 7:
+        # Sony S-Log3
+        if x >= 0.01125:
+            return (420.0 + np.log10((x + 0.01) / 0.19) * 261.5) / 1023.0
+        return (x * (171.2102946929 - 95.0) / 0.01125 + 95.0) / 1023.0
+    elif curve_id == 8:
+        # ARRI LogC3 (SUP 3.x, EI 800)
+        if x > 0.010591:
+            return 0.24719 * np.log10(5.555556 * x + 0.052272) + 0.385537
+        return 5.367655 * x + 0.092809
+    elif curve_id == 9:
+        # ARRI LogC4
+        return (np.log2(2231.8263090676883 * x + 64.0) - 6.0) / 14.0 * 0.9071358748778103 + 0.09286412512218964
+    elif curve_id == 10:
+        # RED Log3G10 (v3)
+        return 0.224282 * np.log10((x + 0.01) * 155.975327 + 1.0)
+    else:
+        # DJI D-Log
+        if x <= 0.0078:
+            return 6.025 * x + 0.0929
+        return np.log10(x * 0.9892 + 0.0108) * 0.256663 + 0.584555
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def _gamut_log_kernel(img, matrix, curve_id):
+    """
+    矩阵变换 + 底噪裁剪 + Log 编码，单次遍历完成。
+    替代了原先 apply_matrix_inplace -> np.maximum -> colour.cctf_encoding 三次整图遍历，
+    同时避免 cctf_encoding 分配新的整图数组。
+    """
+    rows, cols, _ = img.shape
+
+    m00, m01, m02 = matrix[0, 0], matrix[0, 1], matrix[0, 2]
+    m10, m11, m12 = matrix[1, 0], matrix[1, 1], matrix[1, 2]
+    m20, m21, m22 = matrix[2, 0], matrix[2, 1], matrix[2, 2]
+
+    for r in prange(rows):
+        for c in range(cols):
+            r_val = img[r, c, 0]
+            g_val = img[r, c, 1]
+            b_val = img[r, c, 2]
+
+            # 1. Gamut 变换
+            r_out = r_val * m00 + g_val * m01 + b_val * m02
+            g_out = r_val * m10 + g_val * m11 + b_val * m12
+            b_out = r_val * m20 + g_val * m21 + b_val * m22
+
+            # 2. Log 函数无法处理负值，裁剪微小底噪
+            r_out = max(r_out, 1e-6)
+            g_out = max(g_out, 1e-6)
+            b_out = max(b_out, 1e-6)
+
+            # 3. Log 编码并写回
+            img[r, c, 0] = _log_encode(r_out, curve_id)
+            img[r, c, 1] = _log_encode(g_out, curve_id)
+            img[r, c, 2] = _log_encode(b_out, curve_id)
+
+def apply_gamut_and_log_inplace(img, matrix, log_curve_name):
+    """
+    In-Place 完成 ProPhoto Linear -> 目标 Gamut -> Log 编码。
+
+    Args:
+        img: float32, C-contiguous 的线性图像数据
+        matrix: 3x3 Gamut 变换矩阵
+        log_curve_name: Log 曲线名称 (colour 库命名)
+    """
+    curve_id = LOG_CURVE_IDS.get(log_curve_name)
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    if curve_id is None:
+        # 未内置的曲线回退到 colour 库实现
+        import colour
+        apply_matrix_inplace(img, matrix)
+        np.maximum(img, 1e-6, out=img)
+        img[...] = colour.cctf_encoding(img, function=log_curve_name)
+        return img
+
+    _gamut_log_kernel(img, matrix, curve_id)
+    return img
+
+# =========================================================
+# 并行调度 (条带处理 / 线程安全检查)
+# =========================================================
+
+# 每个线程分到的条带数据量上限，约等于单核 L2 缓存大小
+STRIPE_BYTES_PER_THREAD = 512 * 1024
+
+def get_stripe_rows(img, bytes_per_thread=STRIPE_BYTES_PER_THREAD):
+    """
+    计算逐条带处理时每个条带的行数。
+    各 Numba 核函数按行并行，条带总大小按线程数放大，
+    这样每个线程分到的行在连续多个处理阶段之间都能留在自己的 L2 缓存中。
+    """
+    row_bytes = img.shape[1] * img.shape[2] * img.itemsize
+    return max(1, (bytes_per_thread * get_num_threads()) // row_bytes)
+
+def is_numba_threadsafe():
+    """
+    Numba 线程层是否支持多个 Python 线程同时调用并行核函数。
+    tbb / omp 支持；workqueue 不支持，并发调用会直接终止进程。
+    """
+    # 线程层在第一次执行并行核函数时才会加载
+    apply_gain_inplace(np.zeros((1, 1, 3), dtype=np.float32), np.float32(1.0))
+    return threading_layer() != 'workqueue'
+
 # =========================================================
 # 辅助计算函数 (用于测光)
 # =========================================================
 
+# 亮度系数缓存: 色彩空间名称 -> float32 系数
+_LUMINANCE_COEFFS_CACHE = {}
+
 def get_luminance_coeffs(colourspace):
-    """从 colour 空间对象中提取 RGB -> Y (Luminance) 的系数"""
-    # RGB_to_XYZ 矩阵的第二行就是 Y 通道的系数 [Lr, Lg, Lb]
-    return colourspace.matrix_RGB_to_XYZ[1, :]
+    """
+    从 colour 空间对象中提取 RGB -> Y (Luminance) 的系数。
+    结果按色彩空间缓存为 float32，使 float32 图像的点乘不会被提升为 float64。
+    """
+    coeffs = _LUMINANCE_COEFFS_CACHE.get(colourspace.name)
+    if coeffs is None:
+        # RGB_to_XYZ 矩阵的第二行就是 Y 通道的系数 [Lr, Lg, Lb]
+        coeffs = np.ascontiguousarray(colourspace.matrix_RGB_to_XYZ[1, :], dtype=np.float32)
+        _LUMINANCE_COEFFS_CACHE[colourspace.name] = coeffs
+    return coeffs
+
+@lru_cache(maxsize=None)
+def get_gamut_matrix(target_colourspace_name):
+    """
+    ProPhoto RGB -> 目标 Gamut 的变换矩阵 (float32, C-contiguous)。
+    matrix_RGB_to_RGB 涉及色彩空间查找、矩阵求逆和色适应计算，
+    按目标色彩空间缓存后批处理中每种 Gamut 只计算一次。返回的数组为共享缓存，只读。
+    """
+    import colour
+    matrix = colour.matrix_RGB_to_RGB(
+        colour.RGB_COLOURSPACES['ProPhoto RGB'],
+        colour.RGB_COLOURSPACES[target_colourspace_name],
+    )
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    matrix.flags.writeable = False
+    return matrix
 
-def get_subsampled_view(img, target_size=1024):
+@lru_cache(maxsize=8)
+def get_center_weight_mask(h, w):
+    """
+    中央重点测光的高斯权重掩码 (float32, 展平) 及其总和。
+    按 (h, w) 缓存，批处理中同尺寸图像不再重复 ogrid + exp。返回的数组为共享缓存，只读。
+    """
+    y, x = np.ogrid[:h, :w]
+    center_y, center_x = h / 2, w / 2
+    sigma = min(h, w) / 2
+    dist_sq = (x - center_x)**2 + (y - center_y)**2
+    weights = np.exp(-dist_sq / (2 * sigma**2)).astype(np.float32).ravel()
+    weights.flags.writeable = False
+    return weights, float(weights.sum(dtype=np.float64))
+
+def get_subsampled_view(img, target_size=512):
     """
     获取图像的下采样视图。
-    对于测光来说，分析 1000px 宽的缩略图和分析 8000px 的原图，结果差异可忽略不计。
+    对于测光来说，分析 500px 宽的缩略图和分析 8000px 的原图，结果差异可忽略不计。
     """
     h, w, _ = img.shape
     # 计算步长，使得长边大约为 target_size
@@ -409,6 +648,16 @@ def get_subsampled_view(img, target_size=1024):
     # Numpy切片是视图(View)，不占用新内存
     return img[::step, ::step, :]
 
+def fast_percentile(values, q):
+    """
+    O(N) 百分位数，基于 np.partition 的单次选择。
+    取最近秩 (nearest-rank) 而非线性插值，对测光来说差异可忽略，
+    但省去了 np.percentile 的 float64 拷贝和插值开销。
+    """
+    flat = values.ravel()
+    k = min(int(flat.size * q / 100.0), flat.size - 1)
+    return np.partition(flat, k)[k]
+
 # =========================================================
 # 业务逻辑函数 (优化版)
 # =========================================================
@@ -429,21 +678,54 @@ def apply_saturation_and_contrast(img_linear, saturation=1.25, contrast=1.10, co
     if colourspace is None:
         colourspace = colour.RGB_COLOURSPACES['ProPhoto RGB']
     
-    luma_coeffs = get_luminance_coeffs(colourspace).astype(np.float32)
+    luma_coeffs = get_luminance_coeffs(colourspace)
     
     # 确保连续，防止 Numba 变慢
     if not img_linear.flags['C_CONTIGUOUS']:
         img_linear = np.ascontiguousarray(img_linear)
         
+    # 标量使用 float32，保持整个核函数在 float32 下运算 (SIMD 通道数翻倍)
     apply_saturation_contrast_inplace(
         img_linear, 
-        float(saturation), 
-        float(contrast), 
-        0.18, # Pivot center
+        np.float32(saturation), 
+        np.float32(contrast), 
+        np.float32(0.18), # Pivot center
         luma_coeffs
     )
     return img_linear # 为了链式调用方便返回，但实际上是原地修改
 
+def prepare_lut3d_table(lut):
+    """
+    将 3D LUT 的表格转换为 C-contiguous 的 float32，四面体查表时缓存命中率最高。
+    注意: colour 的 LUT3D.table 赋值时会被转回 float64，因此需要单独持有返回的数组。
+    """
+    return np.ascontiguousarray(lut.table, dtype=np.float32)
+
+def apply_lut(img, lut, table=None):
+    """
+    应用 colour.read_LUT 读取的 LUT。
+    3D LUT 使用 Numba 四面体插值 (In-Place)，其他类型回退到 colour 库默认方法。
+
+    Args:
+        img: 图像数据
+        lut: colour LUT 对象
+        table: 可选，prepare_lut3d_table 预处理过的表格 (多次调用时避免重复转换)
+    """
+    import colour
+
+    if not isinstance(lut, colour.LUT3D):
+        return lut.apply(img)
+
+    if not img.flags['C_CONTIGUOUS']:
+        img = np.ascontiguousarray(img)
+    if img.dtype != np.float32:
+        img = img.astype(np.float32)
+
+    if table is None:
+        table = prepare_lut3d_table(lut)
+    apply_lut_inplace(img, table, lut.domain[0], lut.domain[1])
+    return img
+
 # ----------------- 测光函数 (全部改为采样 + In-Place) -----------------
 
 def auto_expose_center_weighted(img_linear: np.ndarray, source_colorspace, target_gray: float = 0.18, logger: callable = print) -> np.ndarray:
@@ -457,14 +739,9 @@ def auto_expose_center_weighted(img_linear: np.ndarray, source_colorspace, targe
     
     h, w = luminance.shape
     
-    # 3. 计算权重 (在小图上计算，内存忽略不计)
-    y, x = np.ogrid[:h, :w]
-    center_y, center_x = h / 2, w / 2
-    sigma = min(h, w) / 2
-    dist_sq = (x - center_x)**2 + (y - center_y)**2
-    weights = np.exp(-dist_sq / (2 * sigma**2))
-    
-    weighted_avg_lum = np.average(luminance, weights=weights)
+    # 3. 加权平均 (权重掩码按尺寸缓存)
+    weights, weights_sum = get_center_weight_mask(h, w)
+    weighted_avg_lum = np.dot(luminance.ravel(), weights) / weights_sum
     
     if weighted_avg_lum < 1e-6:
         gain = 1.0
@@ -476,7 +753,7 @@ def auto_expose_center_weighted(img_linear: np.ndarray, source_colorspace, targe
     
     # 4. 原位应用增益到大图
     # img_linear *= gain # Numpy 写法
-    apply_gain_inplace(img_linear, float(gain)) # Numba 写法 (稍微更省内存)
+    apply_gain_inplace(img_linear, np.float32(gain)) # Numba 写法 (稍微更省内存)
     return img_linear
 
 def auto_expose_highlight_safe(img_linear: np.ndarray, clip_threshold: float = 1.0, logger: callable = print) -> np.ndarray:
@@ -485,7 +762,7 @@ def auto_expose_highlight_safe(img_linear: np.ndarray, clip_threshold: float = 1
     
     # 2. 在小图上找 Max
     max_vals = np.max(sample, axis=2)
-    high_percentile = np.percentile(max_vals, 99.0)
+    high_percentile = fast_percentile(max_vals, 99.0)
     
     target_high = 0.9  
     if high_percentile < 1e-6:
@@ -494,7 +771,7 @@ def auto_expose_highlight_safe(img_linear: np.ndarray, clip_threshold: float = 1
         gain = target_high / high_percentile
         
     logger(f"  🛡️  [Auto Exposure] Highlight Safe Gain: {gain:.4f}")
-    apply_gain_inplace(img_linear, float(gain))
+    apply_gain_inplace(img_linear, np.float32(gain))
     return img_linear
 
 def auto_expose_linear(img_linear: np.ndarray, source_colorspace, target_gray: float = 0.18, logger: callable = print) -> np.ndarray:
@@ -517,7 +794,7 @@ def auto_expose_linear(img_linear: np.ndarray, source_colorspace, target_gray: f
     gain = np.clip(gain, 1.0, 50.0)
     logger(f"  ⚖️  [Auto Exposure] Avg Gain: {gain:.4f}")
     
-    apply_gain_inplace(img_linear, float(gain))
+    apply_gain_inplace(img_linear, np.float32(gain))
     return img_linear
 
 def auto_expose_hybrid(img_linear: np.ndarray, source_colorspace, target_gray: float = 0.18, logger: callable = print) -> np.ndarray:
@@ -534,7 +811,7 @@ def auto_expose_hybrid(img_linear: np.ndarray, source_colorspace, target_gray: f
     
     # 3. 检查高光 (在采样图上检查即可)
     max_vals = np.max(sample, axis=2)
-    p99 = np.percentile(max_vals, 99.0)
+    p99 = fast_percentile(max_vals, 99.0)
     
     potential_peak = p99 * base_gain
     max_allowed_peak = 6.0 
@@ -549,7 +826,7 @@ def auto_expose_hybrid(img_linear: np.ndarray, source_colorspace, target_gray: f
     gain = np.clip(gain, 0.1, 100.0)
     logger(f"  ⚖️  [Auto Exposure] Hybrid Gain: {gain:.4f}")
     
-    apply_gain_inplace(img_linear, float(gain))
+    apply_gain_inplace(img_linear, np.float32(gain))
     return img_linear
 
 def auto_expose_matrix(img_linear: np.ndarray, source_colorspace, target_gray: float = 0.18, logger: callable = print) -> np.ndarray:
@@ -614,7 +891,7 @@ def auto_expose_matrix(img_linear: np.ndarray, source_colorspace, target_gray: f
 
     # 7. 与 Hybrid 类似的保护性削减
     max_vals = np.max(sample, axis=2)
-    p99 = np.percentile(max_vals, 99.0)
+    p99 = fast_percentile(max_vals, 99.0)
     potential_peak = p99 * gain
     max_allowed_peak = 6.0
     
@@ -626,12 +903,12 @@ def auto_expose_matrix(img_linear: np.ndarray, source_colorspace, target_gray: f
     gain = np.clip(gain, 0.1, 100.0)
     logger(f"  🤖 [Auto Exposure] Matrix Gain: {gain:.4f}")
     
-    apply_gain_inplace(img_linear, float(gain))
+    apply_gain_inplace(img_linear, np.float32(gain))
     return img_linear
 
 # ----------------- 镜头校正 (保持逻辑，优化注释) -----------------
 
-def apply_lens_correction(image: np.ndarray, exif_data: dict, custom_db_path: Optional[str] = None, logger: callable = print, **kwargs) -> np.ndarray:
+def apply_lens_correction(image: np.ndarray, exif_data: dict, custom_db_path: Optional[str] = None, logger: callable = print, max_workers: Optional[int] = None, **kwargs) -> np.ndarray:
     """
     镜头校正通常需要几何变换，很难完全 In-Place。
     这是整个流程中少数几个必然会产生内存拷贝的地方。
@@ -659,6 +936,7 @@ def apply_lens_correction(image: np.ndarray, exif_data: dict, custom_db_path: Op
             image=image,
             custom_db_path=custom_db_path,
             logger=logger,
+            max_workers=max_workers,
             **params # 传递所有提取到的参数
         )
         